@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+Shared HTTP session for requests to the NOAA server.
+
+@author: Mario Krapp
+"""
+import threading
+
+TIMEOUT = (5,30)
+
+_SESSION = None
+_LOCK = threading.Lock()
+
+def metadata_url(id):
+    """
+    Returns the NOAA search URL for the metadata of a study.
+    """
+    return f"https://www.ncdc.noaa.gov/paleo-search/study/search.json?NOAAStudyId={id}"
+
+def get_session():
+    """
+    Returns the shared requests session (created on first use).
+
+    Keep-alive connections to the NOAA server are pooled and reused,
+    failed requests are retried.
+    """
+    global _SESSION
+    with _LOCK:
+        if _SESSION is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16,
+                    max_retries=Retry(total=3, backoff_factor=0.3))
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _SESSION = session
+    return _SESSION
@@ -4,12 +4,18 @@
 @author: Mario Krapp
 """
 import io
+import msgspec
+import numpy as np
 import os
 import pandas as pd
 import pickle
-import requests
+import pyarrow
 import sys
-from collections import Counter
+from ._http import get_session, metadata_url, TIMEOUT
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 # https://stackoverflow.com/a/287944/1498309
 HEADER = '\033[95m'
@@ -22,6 +28,10 @@ ENDC = '\033[0m'
 BOLD = '\033[1m'
 UNDERLINE = '\033[4m'
 
+_HOME = os.path.expanduser('~')
+_DEFAULT_CACHE = os.path.join(_HOME, 'noaapaleopy_cache')
+
+
 class NOAAStudy:
     """NOAA Study Class
     This class creates objects to hold data and metadata from the NOAA Paleoclimatology website.
@@ -55,7 +65,8 @@ class NOAAStudy:
 
     def metadata_from_pickle(self, cachedir=''):
         """
-        Loads a NOAA Paleoclimatology metadata object from a pickle file.
+        Loads a NOAA Paleoclimatology metadata object from a msgpack file
+        (falls back to a legacy pickle file).
 
         Parameters
         ----------
@@ -63,40 +74,40 @@ class NOAAStudy:
             the name of the cache directory
         """
 
-        home = os.path.expanduser("~")
         if cachedir=='':
-            cachedir=home+'/'+'noaapaleopy_cache'
+            cachedir=_DEFAULT_CACHE
 
-        ret = False
+        fnm_msgpack = f"{cachedir}/{self.id}.msgpack"
         fnm_pkl = f"{cachedir}/{self.id}.pkl"
-        if os.path.isfile(fnm_pkl):
-            print(f"{BOLD}Loading cached metadata for study {self.id}.{ENDC}")
-            with open(fnm_pkl,'rb') as f:
-                self.metadata = pickle.load(f)
-            ret = True
-        else:
-            ret = False
-        return ret
+        try:
+            with open(fnm_msgpack,'rb') as f:
+                self.metadata = msgspec.msgpack.decode(f.read())
+        except FileNotFoundError:
+            try:
+                with open(fnm_pkl,'rb') as f:
+                    self.metadata = pickle.load(f)
+            except FileNotFoundError:
+                return False
+        print(f"{BOLD}Loading cached metadata for study {self.id}.{ENDC}")
+        return True
 
     def metadata_to_pickle(self, cachedir=''):
         """
-        Save a NOAA Paleoclimatology object to a pickle file.
+        Save a NOAA Paleoclimatology object to a msgpack file.
 
         Parameters
         ---
         cachedir : str
             the name of the cache directory
         """
-        home = os.path.expanduser("~")
         if cachedir=='':
-            cachedir=home+'/'+'noaapaleopy_cache'
-        if not os.path.exists(cachedir):
-            os.makedirs(cachedir)
+            cachedir=_DEFAULT_CACHE
+        os.makedirs(cachedir, exist_ok=True)
 
-        fnm_pkl = f"{cachedir}//{self.id}.pkl"
+        fnm_msgpack = f"{cachedir}/{self.id}.msgpack"
         print(f"{BOLD}Caching metadata for study {self.id}{ENDC}")
-        with open(fnm_pkl,'wb') as f:
-            pickle.dump(self.metadata,f)
+        with open(fnm_msgpack,'wb') as f:
+            f.write(msgspec.msgpack.encode(self.metadata))
 
 
     def get_metadata(self, cachedir=''):
@@ -108,15 +119,18 @@ class NOAAStudy:
         cachedir : str
             the name of the cache directory
         """
-        url_base = f"https://www.ncdc.noaa.gov/paleo-search/study/search.json?NOAAStudyId={self.id}"
-        response = requests.get(url_base).json()
+        url_base = metadata_url(self.id)
+        r = get_session().get(url_base, timeout=TIMEOUT)
+        r.raise_for_status()
+        response = json_loads(r.content)
         self.metadata = response['study'][0]
         if self.cache == True:
             self.metadata_to_pickle()
 
     def data_from_pickle(self, cachedir=''):
         """
-        Load data from NOAA Paleoclimatology study data from a pickle file.
+        Load data from NOAA Paleoclimatology study data from a msgpack (info)
+        and feather (data) file (falls back to a legacy pickle file).
 
         Parameters
         ----------
@@ -124,24 +138,35 @@ class NOAAStudy:
             the name of the cache directory
         """
 
-        home = os.path.expanduser("~")
         if cachedir=='':
-            cachedir=home+'/'+'noaapaleopy_cache'
+            cachedir=_DEFAULT_CACHE
 
-        ret = False
+        fnm_msgpack = f"{cachedir}/{self.id}_{self.ds_id}.msgpack"
+        fnm_feather = f"{cachedir}/{self.id}_{self.ds_id}.feather"
         fnm_pkl = f"{cachedir}/{self.id}_{self.ds_id}.pkl"
-        if os.path.isfile(fnm_pkl):
-            print(f" {BOLD}Loading cached file has been cached for {self.id} [{self.ds_id}].{ENDC}")
-            with open(fnm_pkl,'rb') as f:
-                [self.info,self.data] = pickle.load(f)
-            ret = True
-        else:
-            ret = False
-        return ret
+        try:
+            with open(fnm_msgpack,'rb') as f:
+                info = msgspec.msgpack.decode(f.read())
+            data = pd.read_feather(fnm_feather)
+        except FileNotFoundError:
+            try:
+                with open(fnm_pkl,'rb') as f:
+                    [info,data] = pickle.load(f)
+            except FileNotFoundError:
+                return False
+        except (msgspec.DecodeError, pyarrow.ArrowException, OSError):
+            print(f" {WARNING}Cached file for {self.id} [{self.ds_id}] can't be read.{ENDC}")
+            return False
+        print(f" {BOLD}Loading cached file has been cached for {self.id} [{self.ds_id}].{ENDC}")
+        self.info = info
+        self.data = data
+        return True
 
     def data_to_pickle(self, cachedir=''):
         """
-        Save a NOAA Paleoclimatology dataset to a pickle file.
+        Save a NOAA Paleoclimatology dataset to a msgpack (info)
+        and feather (data) file (skipped if the data can't be stored
+        as feather).
 
         Parameters
         ----------
@@ -149,46 +174,60 @@ class NOAAStudy:
             the name of the cache directory
         """
 
-        home = os.path.expanduser("~")
         if cachedir=='':
-            cachedir=home+'/'+'noaapaleopy_cache'
+            cachedir=_DEFAULT_CACHE
 
-        fnm_pkl = f"{cachedir}/{self.id}_{self.ds_id}.pkl"
+        fnm_msgpack = f"{cachedir}/{self.id}_{self.ds_id}.msgpack"
+        fnm_feather = f"{cachedir}/{self.id}_{self.ds_id}.feather"
 
         print(f" {BOLD}Caching file for {self.id} [{self.ds_id}]{ENDC}")
-        with open(fnm_pkl,'wb') as f:
-            pickle.dump([self.info,self.data],f)
+        # invalidate the cache (msgpack is written last, after the data)
+        try:
+            os.remove(fnm_msgpack)
+        except FileNotFoundError:
+            pass
+        try:
+            self.data.to_feather(fnm_feather)
+        except (pyarrow.ArrowException, ValueError, TypeError):
+            # e.g. columns with mixed types or non-string column names
+            print(f" {WARNING}Data can't be stored as feather. Skipping cache.{ENDC}")
+            return
+        with open(fnm_msgpack,'wb') as f:
+            f.write(msgspec.msgpack.encode(self.info))
 
-    def inspect_data(self):
+    def inspect_data(self, text=None):
         """
         Inspects the dataset and tries to infer tabular data
         from the most common number of columns.
+
+        Parameters
+        ----------
+        text : str
+            the content of the data file (downloaded if not given)
         """
-        res = requests.get(self.info[1]).text.split("\n")
-        ncols = []
-        data = []
-        # reverse order
-        for r in res[::-1]:
-            ncols.append(len(r.split()))
+        if text is None:
+            text = get_session().get(self.info[1], timeout=TIMEOUT).text
+        res = text.split("\n")
+        # number of columns per line (reverse order)
+        ncols = np.array([len(r.split()) for r in res[::-1]], dtype=np.int32)
         # count occurences
-        c = Counter(len(r.split()) for r in res[::-1])
+        vals, cnts = np.unique(ncols, return_counts=True)
         selection = "Select (try the most common): "
-        for col, count in c.most_common(3):
-            selection += f"[{col}]: {count} "
+        for k in np.argsort(-cnts, kind="stable")[:3]:
+            selection += f"[{vals[k]}]: {cnts[k]} "
         n = int(input(selection))
-        print(c[n])
-        # adapted from https://stackoverflow.com/a/40166843/1498309
-        count = 0
-        prev = 0
+        print(cnts[vals == n].sum())
+        # end of the longest run of lines with n columns
+        # (runs reaching the top of the file are not considered)
+        mask = np.concatenate([[False], ncols == n, [False]])
+        edges = np.diff(mask.astype(np.int8))
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1)
+        keep = ends < len(ncols)
+        starts, ends = starts[keep], ends[keep]
         indexend = 0
-        for i in range(0,len(ncols)):
-            if ncols[i] == n:
-                count += 1
-            else:            
-                if count > prev:
-                    prev = count
-                    indexend = i
-                count = 0
+        if len(ends):
+            indexend = int(ends[np.argmax(ends - starts)])
         idx = -indexend+1
         print("Table header detected:")
         print("\n".join(res[idx-5:idx-1]))
@@ -237,14 +276,27 @@ class NOAAStudy:
             self.ds_id = n
         suffix = self.info[1].split(".")[-1]
         if suffix == "txt":
-            try:
-                self.data = pd.read_csv(self.info[1],sep="\t",comment="#",encoding_errors="ignore",na_values=-999.00)
-                if (len(self.data.columns) == 1):
-                    print(f"{FAIL} Could not parse data file. Enter inspection mode.{ENDC}")
-                    self.inspect_data()
-            except:
+            # download once, then peek the first non-comment line
+            # to check for tab-separated data
+            r = get_session().get(self.info[1], timeout=TIMEOUT)
+            r.raise_for_status()
+            body = r.content
+            first = b""
+            for line in io.BytesIO(body):
+                if line.strip() and not line.startswith(b"#"):
+                    first = line
+                    break
+            if not first:
                 print(f"{FAIL} Could not parse data file. Skipping.{ENDC}")
-                pass
+            else:
+                if b"\t" in first:
+                    try:
+                        self.data = pd.read_csv(io.BytesIO(body),sep="\t",comment="#",encoding_errors="ignore",na_values=-999.00)
+                    except pd.errors.ParserError as e:
+                        print(f"{FAIL} {e}{ENDC}")
+                if (len(self.data.columns) <= 1):
+                    print(f"{FAIL} Could not parse data file. Enter inspection mode.{ENDC}")
+                    self.inspect_data(body.decode("utf-8", errors="ignore"))
         elif suffix == "csv":
             self.data = pd.read_csv(self.info[1],encoding_errors="ignore",na_values=-999.00)
         else:
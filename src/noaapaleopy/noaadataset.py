@@ -3,16 +3,27 @@
 
 @author: Mario Krapp
 """
-import io
+import hashlib
 import os
 import json
+import msgspec
 import numpy as np
 import pandas as pd
 import pickle
-import requests
+import pyarrow
 import sys
-from collections import Counter, OrderedDict
+import threading
+import time
+from collections import OrderedDict
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from types import MappingProxyType
+from ._http import get_session, metadata_url, TIMEOUT
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 #LEVEL = logging.DEBUG
 LEVEL = logging.INFO
@@ -27,6 +38,29 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 logging.basicConfig(filename='/tmp/noaapaleopy.log', level=LEVEL)
 
+_HOME = os.path.expanduser('~')
+_DEFAULT_CACHE = os.path.join(_HOME, 'noaapaleopy_cache')
+# limit the number of concurrent metadata requests to the NOAA server
+_RATE_LIMIT = threading.BoundedSemaphore(8)
+
+# map of age units to a common unit
+_AGE_UNIT_MAP = MappingProxyType({
+    "calendar kiloyear before present": "ka BP",
+    "calendar kiloyears before present": "ka BP",
+    "cal kyr BP": "ka BP",
+    "calendar kyears before present": "ka BP",
+    "Age_kyr": "ka BP",
+    "cal ka BP": "ka BP",
+    "calendar ka before 1950AD": "ka BP",
+    "calendar kiloyears before 1950 AD": "ka BP",
+    "calendar kiloyears before 1950": "ka BP",
+    "calendar Kyears before present": "ka BP",
+    "kyr BP": "ka BP",
+    "kyrs": "ka BP",
+    "calendar ka before present": "ka BP",
+    "cal kiloyears before present": "ka BP"
+    })
+
 
 class NOAAEvent:
     """NOAA Event Class
@@ -39,8 +73,9 @@ class NOAAEvent:
     ----------
 
     """
+    logger = logging.getLogger('NOAAPaleoPy.Event')
+
     def __init__(self, label, lon, lat):
-        self.logger = logging.getLogger('NOAAPaleoPy.Event')
         self.label  = label
         self.lat    = lat
         self.lon    = lon
@@ -71,29 +106,12 @@ class NOAAParam:
         the unit of measurement used with this parameter (e.g. m/s, kg etc..)
     
     """
+    logger = logging.getLogger('NOAAPaleoPy.Param')
+
     def __init__(self, name, long_name, unit=None):
-        self.logger = logging.getLogger('NOAAPaleoPy.Param')
-        ages = {
-                "calendar kiloyear before present": "ka BP",
-                "calendar kiloyears before present": "ka BP",
-                "cal kyr BP": "ka BP",
-                "calendar kyears before present": "ka BP",
-                "Age_kyr": "ka BP",
-                "cal ka BP": "ka BP",
-                "calendar ka before 1950AD": "ka BP",
-                "calendar kiloyears before 1950 AD": "ka BP",
-                "calendar kiloyears before 1950": "ka BP",
-                "calendar Kyears before present": "ka BP",
-                "kyr BP": "ka BP",
-                "kyrs": "ka BP",
-                "calendar ka before present": "ka BP",
-                "cal kiloyears before present": "ka BP"
-                }
         self.name      = name
         self.long_name = long_name
-        self.unit      = unit
-        if self.unit in ages.keys():
-            self.unit = ages[self.unit]
+        self.unit      = _AGE_UNIT_MAP.get(unit, unit)
         self.logger.info(f"New Param '{self.name}' [{self.unit}]")
 
 class NOAATable:
@@ -107,9 +125,12 @@ class NOAATable:
     ----------
 
     """
+    logger = logging.getLogger('NOAAPaleoPy.Table')
+    # downcast float columns to float32 after reading (opt-in, values are
+    # rounded to ~7 significant digits)
+    downcast = False
 
     def __init__(self,params,data,event):
-        self.logger = logging.getLogger('NOAAPaleoPy.Table')
         self.params = params
         self.data   = data
         self.event  = event
@@ -120,80 +141,97 @@ class NOAATable:
         components = ["what", "material", "error", "units", "seasonality", "archive", "detail", "method", "format"]
         params = []
         skiprows = 0
-        intermediate = 0
-        with open(file_url,"r", encoding="utf-8", errors="ignore") as f:
-            all_lines = f.read().splitlines()
-            # store lines with parameters
-            parameter_lines = []
-            for l in all_lines:
-                if l.startswith("##"):
-                    parameter_lines.append(l.split("##")[-1])
-                if l.startswith("#"):
-                    skiprows = skiprows + 1 + intermediate
-                    intermediate = 0
-                else:
-                    intermediate += 1
-            logger.debug(f"skiprows = {skiprows}")
-
-            # parse order of params from ## lines:
-            for line in parameter_lines:
-                p = line.split()[0]
-                l = line.replace(p,"")
-                p = p.strip()
-                this_param = {"name": p}
-                for i,c in enumerate(components):
-                    x = l.split(",")
-                    if i < len(x):
-                        this_param[c] = x[i].strip() 
-                        logger.debug(f"{p} - {c}: {x[i].strip()}")
-                params.append(this_param)
-
-            # read tabular data
-            na_values = [-999.00,-9999.00]
-            columns = [p["name"] for p in params]
-            # https://stackoverflow.com/a/56454407/1498309
-            d = {a:[i if i > 0 else "" for i in range(b)] if b>1 else '' for a,b in Counter(columns).items()}
-            columns = [i+str(d[i].pop(0)) if len(d[i]) else i for i in columns]
-            for i,p in enumerate(params):
-                p["name"] = columns[i]
-            logger.debug(f"columns: {columns} ({len(columns)})")
-            logger.info(f"params: {columns}")
-            usecols = list(range(len(columns)))
-            # create StringIO object to pass on to Pandas
-            s = io.StringIO("\n".join(all_lines))
-            df = pd.read_csv(s,index_col=False,sep="\t",encoding_errors="ignore",
-                    on_bad_lines='skip',na_values=na_values,
-                    usecols=usecols,skiprows=skiprows)
-            # assign columns names (may be different from actual table column names)
-            df.columns = columns
-            # add event-specific information
-            df["Event"]     = event.label
-            df["Latitude"]  = event.lat
-            df["Longitude"] = event.lon
-            #logger.debug(df)
-            logger.debug("START Table info:\n"+df.describe().loc[["min","max"]].to_string())
-            logger.debug("END Table info")
-            # store parameters
-            noaa_params = OrderedDict()
-            for p in params:
-                if "units" in p.keys():
-                    unit = p["units"]
-                else:
-                    unit = ""
-                noaa_params[p["name"]] = NOAAParam(name=p["name"],long_name=p["what"],unit=unit)
-            
+        with open(file_url,"rb") as f:
+            # single pass over all lines: parse parameters and count header rows
+            # (up to the last # line, non-comment lines within the header are skipped too)
+            for i,line in enumerate(f):
+                if i == 0 and line.startswith(b"\xef\xbb\xbf"):
+                    line = line[3:]
+                if not line.startswith(b"#"):
+                    continue
+                skiprows = i + 1
+                # parse order of params from ## lines:
+                if line.startswith(b"##"):
+                    line = line.decode("utf-8", errors="ignore").split("##")[-1]
+                    # name followed by comma-separated components
+                    name, *rest = line.split(None, 1)
+                    parts = [x.strip() for x in rest[0].split(",", len(components))] if rest else [""]
+                    this_param = {"name": name, **dict(zip(components, parts))}
+                    logger.debug(f"{this_param}")
+                    params.append(this_param)
+        if not params:
+            logger.warning(f"No parameters (## lines) found in '{file_url}'.")
+        logger.debug(f"skiprows = {skiprows}")
+
+        # read tabular data
+        na_values = [-999.00,-9999.00]
+        columns = [p["name"] for p in params]
+        # make duplicate column names unique (a, a1, a2, ...)
+        seen = {}
+        out = []
+        for c in columns:
+            k = seen.get(c, 0)
+            out.append(c if k == 0 else f"{c}{k}")
+            seen[c] = k + 1
+        columns = out
+        for i,p in enumerate(params):
+            p["name"] = columns[i]
+        logger.debug(f"columns: {columns} ({len(columns)})")
+        logger.info(f"params: {columns}")
+        usecols = list(range(len(columns)))
+        # let the C parser read the (memory-mapped) file and skip the header itself
+        df = pd.read_csv(file_url,index_col=False,sep="\t",encoding_errors="ignore",
+                on_bad_lines='skip',na_values=na_values,
+                usecols=usecols,skiprows=skiprows,engine="c",low_memory=False,
+                memory_map=True)
+        # assign columns names (may be different from actual table column names)
+        df.columns = columns
+        # use 32-bit floats to save memory
+        if cls.downcast:
+            for c in df.select_dtypes("float").columns:
+                df[c] = pd.to_numeric(df[c], downcast="float")
+        # add event-specific information
+        df["Event"]     = event.label
+        df["Latitude"]  = event.lat
+        df["Longitude"] = event.lon
+        #logger.debug(df)
+        logger.debug("START Table info:\n"+df.describe().loc[["min","max"]].to_string())
+        logger.debug("END Table info")
+        # store parameters
+        noaa_params = OrderedDict()
+        for p in params:
+            if "units" in p.keys():
+                unit = p["units"]
+            else:
+                unit = ""
+            noaa_params[p["name"]] = NOAAParam(name=p["name"],long_name=p["what"],unit=unit)
+        
         return cls(noaa_params,df,event)
 
     @staticmethod
     def download(url, fnm):
         logger = logging.getLogger('NOAAPaleoPy.Table.download')
         logger.info(f"Download '{url}' to '{fnm}'")
-        # open in binary mode
-        with open(fnm, "wb") as file:
-            # get request
-            response = requests.get(url)
-            # write to file
-            file.write(response.content)
+        # stream response to a temporary file (opened in binary mode),
+        # only complete downloads are moved to fnm
+        fnm_part = fnm+".part"
+        try:
+            with get_session().get(url, stream=True, timeout=(5,60)) as r:
+                r.raise_for_status()
+                # expected size (only meaningful if body is not transfer-encoded)
+                size = None
+                if "Content-Length" in r.headers and "Content-Encoding" not in r.headers:
+                    size = int(r.headers["Content-Length"])
+                with open(fnm_part, "wb") as file:
+                    for chunk in r.iter_content(chunk_size=65536):
+                        file.write(chunk)
+            if size is not None and os.path.getsize(fnm_part) != size:
+                raise IOError(f"Incomplete download of '{url}' ({size} bytes expected).")
+        except BaseException:
+            if os.path.exists(fnm_part):
+                os.remove(fnm_part)
+            raise
+        os.replace(fnm_part, fnm)
 
 class NOAADataSet:
     """NOAA DataSet Class
@@ -206,9 +244,11 @@ class NOAADataSet:
     ----------
 
     """
+    logger = logging.getLogger('NOAAPaleoPy.DataSet')
+    # time (in seconds) after which cached metadata is revalidated
+    cache_ttl = 24*3600
 
     def __init__(self, id, cache=True, metadata={}, data=pd.DataFrame(), params=dict(), title=None, events=[]):
-        self.logger = logging.getLogger('NOAAPaleoPy.DataSet')
         self.cache      = cache
         self.metadata   = metadata
         # attributes according to PanDatSet
@@ -219,7 +259,7 @@ class NOAADataSet:
         self.data       = data
         self.logger.info(f"New DataSet '{self.id}'")
         # read metadata
-        if self.cache == True:
+        if self.cache == True and not self.metadata:
             self.metadata = self.metadata_from_json()
         if not self.metadata:        
             self.metadata = self.get_metadata()
@@ -230,6 +270,8 @@ class NOAADataSet:
         self.logger.info(f"Title: {self.title}")
         self.logger.info(f"DOI: {self.doi}")
         has_data        = False
+        if self.cache == True:
+            has_data = self.data_from_feather()
 
         # iteate over events (sites)
         if not has_data:
@@ -240,12 +282,60 @@ class NOAADataSet:
         self.logger.debug("START DataSet info:\n"+self.data.head().to_string())
         self.logger.debug("END DataSet info")
 
-    def get_data(self):
-        home = os.path.expanduser("~")
-        cachedir=home+'/'+'noaapaleopy_cache'
+    @classmethod
+    def bulk(cls, ids, cache=True, max_workers=8):
+        """
+        Create data sets for several NOAA studies and fetch their metadata concurrently.
+
+        Parameters
+        ----------
+        ids : list
+            the NOAA study ids
+        cache : bool
+            whether to use (and write) the local cache
+        max_workers : int
+            the maximum number of concurrent metadata requests
+
+        Returns
+        -------
+        list
+            the NOAADataSet objects (in the order of ids)
+        """
+        cachedir=_DEFAULT_CACHE
+
+        def fetch(id):
+            # cached metadata is loaded by the constructor
+            if cache == True and os.path.isfile(f"{cachedir}/{id}.json"):
+                return {}, None
+            try:
+                with _RATE_LIMIT:
+                    response = get_session().get(metadata_url(id), timeout=TIMEOUT)
+                response.raise_for_status()
+                return json_loads(response.content)['study'][0], response.headers.get("ETag")
+            except Exception as e:
+                # the constructor falls back to a regular request
+                cls.logger.warning(f"Couldn't fetch metadata for study {id}.", exc_info=e)
+                return {}, None
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(fetch, ids))
+        datasets = []
+        for id,(metadata,etag) in zip(ids,results):
+            ds = cls(id=id, cache=cache, metadata=metadata)
+            if cache == True and metadata:
+                ds.metadata_to_json(metadata, etag=etag)
+            datasets.append(ds)
+        return datasets
+
+    def get_data(self, max_workers=8):
+        # Download files locally
+        table_dir = os.path.join(_DEFAULT_CACHE, str(self.id))
+        os.makedirs(table_dir, exist_ok=True)
         self.data = pd.DataFrame()
         self.params = OrderedDict()
         self.events = []
+        # collect (event, file_url, local_file) for all data files
+        tasks = []
         for i,site in enumerate(self.metadata['site']):
             siteName = site['siteName']
             lat = site["geo"]["geometry"]["coordinates"][0]
@@ -257,21 +347,29 @@ class NOAADataSet:
                 for n,d in enumerate(table['dataFile']):
                     file_url = d['fileUrl']
                     self.logger.info(f"File: {file_url}.")
-                    # Download files locally
-                    table_dir = cachedir+"/"+str(self.id)
-                    if not os.path.exists(table_dir):
-                        os.makedirs(table_dir)
                     local_file = table_dir+"/"+file_url.split("/")[-1]
-                    if not os.path.exists(local_file):
-                        NOAATable.download(file_url,local_file)
-                    if os.path.isdir(local_file):
-                        logger.warning("File is a directory (skipping)!")
-                    file_url = local_file
-                    if file_url.split(".")[-1] == "txt":
-                        t = NOAATable.from_txtfile(file_url,event)
-                        self.data = pd.concat([self.data,t.data],axis=0,ignore_index=True)
-                        self.params.update(t.params)
-
+                    tasks.append((event,file_url,local_file))
+        # download missing files concurrently (I/O-bound, shares the session pool)
+        # (one download per local file, the same file may be listed more than once)
+        missing = {local_file: file_url for _,file_url,local_file in tasks if not os.path.exists(local_file)}
+        if missing:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(NOAATable.download, missing.values(), missing.keys()))
+        # parse sequentially
+        frames = []
+        for event,file_url,local_file in tasks:
+            if os.path.isdir(local_file):
+                logger.warning("File is a directory (skipping)!")
+            file_url = local_file
+            if file_url.split(".")[-1] == "txt":
+                t = NOAATable.from_txtfile(file_url,event)
+                frames.append(t.data)
+                self.params.update(t.params)
+        # concatenate all tables at once
+        if frames:
+            self.data = pd.concat(frames,axis=0,ignore_index=True)
+        if self.cache == True:
+            self.data_to_feather()
 
 #    def save_data(self,fnm):
 #        self.data.to_csv(fnm)
@@ -289,6 +387,88 @@ class NOAADataSet:
 #            params.update(t.params)
 #        return cls(id,data=data,params=params)
 
+    def data_from_feather(self, cachedir=''):
+        """
+        Loads the data, parameters, and events of a NOAA Paleoclimatology
+        data set from a feather (data) and msgpack (params, events) file.
+        The cache is only used if it was created from the current metadata.
+
+        Parameters
+        ----------
+        cachedir : str
+            the name of the cache directory
+        """
+
+        if cachedir=='':
+            cachedir=_DEFAULT_CACHE
+
+        fnm_feather = f"{cachedir}/{self.id}.dataset.feather"
+        fnm_msgpack = f"{cachedir}/{self.id}.dataset.msgpack"
+        try:
+            with open(fnm_msgpack,'rb') as f:
+                cached = msgspec.msgpack.decode(f.read())
+        except FileNotFoundError:
+            return False
+        except (msgspec.DecodeError, OSError) as e:
+            self.logger.warning(f"Loading cached data for study {self.id} failed.", exc_info=e)
+            return False
+        if not isinstance(cached, dict) or cached.get("metadata") != self._metadata_hash():
+            self.logger.info(f"Cached data for study {self.id} is outdated.")
+            return False
+        self.logger.info(f"Loading cached data for study {self.id}.")
+        try:
+            data = pd.read_feather(fnm_feather, use_threads=True)
+            events = [NOAAEvent(**e) for e in cached["events"]]
+            params = OrderedDict((p["name"],NOAAParam(**p)) for p in cached["params"])
+        except (pyarrow.ArrowException, KeyError, TypeError, OSError) as e:
+            self.logger.warning(f"Loading cached data for study {self.id} failed.", exc_info=e)
+            return False
+        self.data = data
+        self.events = events
+        self.params = params
+        return True
+
+    def data_to_feather(self, cachedir=''):
+        """
+        Save the data, parameters, and events of a NOAA Paleoclimatology
+        data set to a feather (data) and msgpack (params, events) file.
+
+        Parameters
+        ----------
+        cachedir : str
+            the name of the cache directory
+        """
+        if cachedir=='':
+            cachedir=_DEFAULT_CACHE
+        os.makedirs(cachedir, exist_ok=True)
+
+        if self.data.empty:
+            return
+        fnm_feather = f"{cachedir}/{self.id}.dataset.feather"
+        fnm_msgpack = f"{cachedir}/{self.id}.dataset.msgpack"
+        self.logger.info(f"Caching data for study {self.id}.")
+        # invalidate the cache (msgpack is written last, after the data)
+        try:
+            os.remove(fnm_msgpack)
+        except FileNotFoundError:
+            pass
+        try:
+            self.data.to_feather(fnm_feather)
+        except (pyarrow.ArrowException, ValueError, TypeError) as e:
+            self.logger.warning(f"Caching data for study {self.id} failed (skipping).", exc_info=e)
+            return
+        cached = {
+                "metadata": self._metadata_hash(),
+                "events": [{"label": e.label, "lon": e.lon, "lat": e.lat} for e in self.events],
+                "params": [{"name": p.name, "long_name": p.long_name, "unit": p.unit} for p in self.params.values()]
+                }
+        with open(fnm_msgpack,'wb') as f:
+            f.write(msgspec.msgpack.encode(cached))
+
+    def _metadata_hash(self):
+        # fingerprint of the metadata the data has been created from
+        return hashlib.sha1(msgspec.msgpack.encode(self.metadata)).hexdigest()
+
     def metadata_from_json(self, cachedir=''):
         """
         Loads a NOAA Paleoclimatology metadata object from a json file.
@@ -299,21 +479,28 @@ class NOAADataSet:
             the name of the cache directory
         """
 
-        home = os.path.expanduser("~")
         if cachedir=='':
-            cachedir=home+'/'+'noaapaleopy_cache'
+            cachedir=_DEFAULT_CACHE
 
         fnm_json = f"{cachedir}/{self.id}.json"
-        metadata = {}
-        if os.path.isfile(fnm_json):
-            self.logger.info(f"Loading cached metadata for study {self.id}.")
-            with open(fnm_json,'r') as f:
-                metadata = json.load(f)
-        else:
+        try:
+            mtime = os.stat(fnm_json).st_mtime
+        except FileNotFoundError:
             self.logger.warning(f"Loading cached metadata from '{fnm_json}' failed ({self.id}).")
+            return {}
+        # revalidate stale metadata with the NOAA server
+        if time.time() - mtime > self.cache_ttl:
+            self.logger.info(f"Cached metadata for study {self.id} is stale. Revalidating.")
+            try:
+                return self.get_metadata(cachedir)
+            except Exception as e:
+                self.logger.warning(f"Revalidating cached metadata failed ({self.id}).", exc_info=e)
+        self.logger.info(f"Loading cached metadata for study {self.id}.")
+        with open(fnm_json,'rb') as f:
+            metadata = json_loads(f.read())
         return metadata
 
-    def metadata_to_json(self, metadata, cachedir=''):
+    def metadata_to_json(self, metadata, cachedir='', etag=None):
         """
         Save a NOAA Paleoclimatology object to a json file.
 
@@ -321,17 +508,27 @@ class NOAADataSet:
         ---
         cachedir : str
             the name of the cache directory
+        etag : str
+            the ETag of the server response (stored next to the json file)
         """
-        home = os.path.expanduser("~")
         if cachedir=='':
-            cachedir=home+'/'+'noaapaleopy_cache'
-        if not os.path.exists(cachedir):
-            os.makedirs(cachedir)
+            cachedir=_DEFAULT_CACHE
+        os.makedirs(cachedir, exist_ok=True)
 
         fnm_json = f"{cachedir}/{self.id}.json"
         self.logger.info(f"Caching metadata for study {self.id}.")
         with open(fnm_json,'w') as f:
             json.dump(metadata,f)
+        fnm_etag = f"{cachedir}/{self.id}.etag"
+        if etag is not None:
+            with open(fnm_etag,'w') as f:
+                f.write(etag)
+        else:
+            # an old ETag doesn't belong to the new json file
+            try:
+                os.remove(fnm_etag)
+            except FileNotFoundError:
+                pass
 
 
     def get_metadata(self, cachedir=''):
@@ -343,10 +540,30 @@ class NOAADataSet:
         cachedir : str
             the name of the cache directory
         """
-        url_base = f"https://www.ncdc.noaa.gov/paleo-search/study/search.json?NOAAStudyId={self.id}"
+        if cachedir=='':
+            cachedir=_DEFAULT_CACHE
+
+        url_base = metadata_url(self.id)
         self.logger.info(f"Get metdata from '{url_base}'")
-        response = requests.get(url_base).json()
-        metadata = response['study'][0]
+        # conditional request if metadata has been cached before
+        headers = {}
+        fnm_json = f"{cachedir}/{self.id}.json"
+        fnm_etag = f"{cachedir}/{self.id}.etag"
+        if self.cache == True and os.path.isfile(fnm_json):
+            headers["If-Modified-Since"] = formatdate(os.stat(fnm_json).st_mtime, usegmt=True)
+            if os.path.isfile(fnm_etag):
+                with open(fnm_etag,'r') as f:
+                    headers["If-None-Match"] = f.read().strip()
+        response = get_session().get(url_base, headers=headers, timeout=TIMEOUT)
+        if response.status_code == 304:
+            self.logger.info(f"Metadata for study {self.id} not modified.")
+            # mark cached metadata as fresh and load it
+            # (not via metadata_from_json, which would revalidate again)
+            os.utime(fnm_json)
+            with open(fnm_json,'rb') as f:
+                return json_loads(f.read())
+        response.raise_for_status()
+        metadata = json_loads(response.content)['study'][0]
         if self.cache == True:
-            self.metadata_to_json(metadata)
+            self.metadata_to_json(metadata, cachedir, etag=response.headers.get("ETag"))
         return  metadata